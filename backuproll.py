@@ -13,55 +13,171 @@ Options:
   --version          Print version info and exit.
   --verbose          Print things.
   --simulate         Don't do any destructive operation, implies --verbose
+  --jobs=<jobs>      Number of worlds to back up and roll at the same time. Defaults to max_parallel_worlds from the config.
 
 """
 
 import sys
 import datetime
+import fcntl
 import os
 import pathlib
+import bisect
+import concurrent.futures
 import contextlib
+import copy
+import functools
+import itertools
 import json
+import operator
+import re
+import shlex
+import shutil
 import subprocess
+import threading
+import traceback
 
 from docopt import docopt
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 __version__ = '0.1'
+DEFAULT_KEEP = {
+    "recent": 6,
+    "daily": 10,
+    "weekly": 4,
+    "monthly": 6
+}
 DEFAULT_CONFIG = {
     "backupcommand": "/opt/wurstmineberg/bin/minecraft backup",
     "backupfolder": "/opt/wurstmineberg/backup/worlds/",
     "worlds": {
         "testworld": {
-            "keep": {
-                "recent": 6,
-                "daily": 10,
-                "weekly": 4,
-                "monthly": 6
-            }
+            "keep": DEFAULT_KEEP
         }
     },
-    "pidfile": "/var/local/wurstmineberg/backuproll.pid"
+    "pidfile": "/var/local/wurstmineberg/backuproll.pid",
+    "max_parallel_worlds": 1
 }
 
+def _head(backups, keep):
+    """Returns all but the last keep backups of a sorted listing. Unlike backups[:-keep] this also works for keep == 0
+       Listings are sorted once when scanned and cached, so this is a slice rather than another (partial) sort"""
+    return backups[:-keep] if keep else backups
+
+def _is_lexicographic(dateformat):
+    """Whether dates in this format sort the same as strings, i.e. it only has numeric fields from year down
+       This only holds for zero-padded dates, so backups in such a format are parsed with _date_parser(padded=True)"""
+    directives = re.findall(r'%(.)', dateformat)
+    return (len(directives) > 0 and directives == ['Y', 'm', 'd', 'H', 'M', 'S'][:len(directives)]
+        and not re.search(r'\s', dateformat))
+
+# The same patterns strptime uses for these directives, see _strptime.TimeRE
+_DATE_DIRECTIVES = {
+    'Y': ('year', r'\d\d\d\d'),
+    'm': ('month', r'1[0-2]|0[1-9]|[1-9]'),
+    'd': ('day', r'3[01]|[12]\d|0[1-9]|[1-9]| [1-9]'),
+    'H': ('hour', r'2[0-3]|[0-1]\d|\d'),
+    'M': ('minute', r'[0-5]\d|\d'),
+    'S': ('second', r'[0-5]\d|\d')
+}
+# The same without the unpadded alternatives
+_PADDED_DATE_DIRECTIVES = {
+    'Y': ('year', r'\d\d\d\d'),
+    'm': ('month', r'1[0-2]|0[1-9]'),
+    'd': ('day', r'3[01]|[12]\d|0[1-9]'),
+    'H': ('hour', r'2[0-3]|[0-1]\d'),
+    'M': ('minute', r'[0-5]\d'),
+    'S': ('second', r'[0-5]\d')
+}
+
+@functools.lru_cache(maxsize=None)
+def _date_parser(dateformat, padded=False):
+    """Returns a function parsing dates in the given format
+       Formats made only of numeric date and time fields are parsed with a compiled regex, which is much faster than
+       strptime. Anything else falls back to strptime. If padded is true, fields must have their full width."""
+    directives = _PADDED_DATE_DIRECTIVES if padded else _DATE_DIRECTIVES
+    pattern = ''
+    fields = []
+    for literal, directive in re.findall(r'([^%]*)(?:%(.)|$)', dateformat, re.DOTALL):
+        if re.search(r'\s', literal) or (directive and (directive not in directives or directives[directive][0] in fields)):
+            return lambda datestr: datetime.datetime.strptime(datestr, dateformat)
+        pattern += re.escape(literal)
+        if directive:
+            field, field_pattern = directives[directive]
+            pattern += '({})'.format(field_pattern)
+            fields.append(field)
+    if 'year' not in fields or dateformat.endswith('%'):
+        return lambda datestr: datetime.datetime.strptime(datestr, dateformat)
+    regex = re.compile(pattern + r'\Z', re.IGNORECASE)
+    # For each datetime argument the regex group holding it, or the value strptime defaults it to
+    layout = [ (fields.index(field), None) if field in fields else (None, default) for field, default in (
+        ('year', None), ('month', 1), ('day', 1), ('hour', 0), ('minute', 0), ('second', 0)) ]
+
+    def parse(datestr):
+        match = regex.match(datestr)
+        if match is None:
+            raise ValueError("time data {!r} does not match format {!r}".format(datestr, dateformat))
+        values = match.groups()
+        return datetime.datetime(*[ default if index is None else int(values[index]) for index, default in layout ])
+    return parse
+
+class _DatetimeView:
+    """Read-only sequence of the datetimes of a sorted list of backups, so bisect can compare datetimes directly"""
+    __slots__ = ('backups',)
+
+    def __init__(self, backups):
+        self.backups = backups
+
+    def __len__(self):
+        return len(self.backups)
+
+    def __getitem__(self, index):
+        return self.backups[index].datetime
+
+def _first_between(backups, start, end, lo=0):
+    """Returns the earliest of the sorted backups from start (inclusive) to end (exclusive), or None"""
+    index = bisect.bisect_left(_DatetimeView(backups), start, lo)
+    if index < len(backups) and backups[index].datetime < end:
+        return backups[index]
+    return None
+
+_output_lock = threading.Lock()
+
+def _log(message, file=None, name=None):
+    """Prints the message in one piece, so output from worlds rolled in parallel doesn't interleave
+       If name is given (usually the world) the message is prefixed with it"""
+    if file is None:
+        file = sys.stdout
+    if name is not None:
+        message = '{}: {}'.format(name, message)
+    with _output_lock:
+        file.write(message + '\n')
+        file.flush()
+
 class BackupFile:
-    def __init__(self, basedir, filename, prefix, suffix, dateformat):
+    __slots__ = ('basedir', 'filename', 'path', 'datetime', 'date', 'isoweek', 'month')
+
+    def __init__(self, basedir, filename, timestamp, path=None):
+        """timestamp is the datetime parsed from the file name"""
         self.basedir = basedir
         self.filename = filename
-        self.prefix = prefix
-        self.suffix = suffix
-        self.dateformat = dateformat
-        self.path = os.path.join(basedir, filename)
-
-    @property
-    def datetime(self):
-        datestr = self.filename[len(self.prefix):-len(self.suffix)]
-        return datetime.datetime.strptime(datestr, self.dateformat)
+        self.path = os.path.join(basedir, filename) if path is None else path
+        self.datetime = timestamp
+        self.date = timestamp.date()
+        # Weeks and months include the (ISO) year so they don't match across years
+        self.isoweek = tuple(timestamp.isocalendar()[:2])
+        self.month = (timestamp.year, timestamp.month)
 
     def __repr__(self):
         return "<Backup from date '{}'>".format(self.datetime, self.filename)
 
 class BackupRoll:
-    def __init__(self, backupdir, prefix, suffix, dateformat, keepdict, simulate=False, verbose=False):
+    def __init__(self, backupdir, prefix, suffix, dateformat, keepdict, simulate=False, verbose=False, name=None):
+        """name is used to tell apart the output of BackupRolls running in parallel, usually the world name"""
         self.backupdir = backupdir
         self.prefix = prefix
         self.suffix = suffix
@@ -69,6 +185,14 @@ class BackupRoll:
         self.keepdict = keepdict
         self.simulate = simulate
         self.verbose = verbose
+        self.name = name
+        self._cache = {}
+        self._index_cache = {}
+        # Comparing file names is much cheaper than comparing datetimes
+        self._sort_attr = 'filename' if _is_lexicographic(dateformat) else 'datetime'
+        # Unpadded dates would sort out of order by file name, so they aren't accepted then
+        self._parse = _date_parser(dateformat, padded=self._sort_attr == 'filename')
+        self._name_re = re.compile(re.escape(prefix) + '(.+)' + re.escape(suffix) + r'\Z', re.DOTALL)
 
     @property
     def dailydir(self):
@@ -83,52 +207,48 @@ class BackupRoll:
         return os.path.join(self.backupdir, 'monthly')
 
     def sorted_backups(self, backups):
-        return sorted(backups, key=lambda b: b.datetime)
+        return sorted(backups, key=operator.attrgetter(self._sort_attr))
 
     def select_promote_daily_backup(self, backups, date):
         """Selects the backup to promote as daily backup for the calendar day given
-           This selects the latest backup earlier than 13:00 if possible"""
-        backups = [ b for b in backups if b.datetime.date() == date ]
-        selected_backup = None
-        if len(backups) >= 1:
-            selected_backup = backups[0]
-            for backup in backups:
-                if backup.datetime.hour < 13:
-                    selected_backup = backup
-        return selected_backup
+           This selects the latest backup earlier than 13:00 if possible
+           backups must be sorted by date, like the list_backups_* results"""
+        datetimes = _DatetimeView(backups)
+        start = datetime.datetime.combine(date, datetime.time())
+        first = bisect.bisect_left(datetimes, start)
+        before_13 = bisect.bisect_left(datetimes, start.replace(hour=13), first)
+        if before_13 > first:
+            return backups[before_13 - 1]
+        return _first_between(backups, start, start + datetime.timedelta(days=1), first)
 
     def select_promote_weekly_backup(self, backups, date):
         """Selects the backup to promote as weekly backup for the first day of the calendar week
-           the given day is in"""
-        weeknumber = date.isocalendar()[1]
-        backups = [ b for b in backups if b.datetime.isocalendar()[1] == weeknumber ]
-        selected_backup = None
-        if len(backups) >= 1:
-            selected_backup = backups[0]
-        return selected_backup
+           the given day is in
+           backups must be sorted by date, like the list_backups_* results"""
+        start = datetime.datetime.combine(date - datetime.timedelta(days=date.weekday()), datetime.time())
+        return _first_between(backups, start, start + datetime.timedelta(weeks=1))
 
     def select_promote_monthly_backup(self, backups, date):
         """Selects the backup to promote as monthly backup for the first day of the month
-           the given day is in"""
-        month = date.month
-        backups = [ b for b in backups if b.datetime.month == month ]
-        selected_backup = None
-        if len(backups) >= 1:
-            selected_backup = backups[0]
-        return selected_backup
-
-    def should_promote_daily_backup(self, date):
-        now = datetime.datetime.utcnow()
+           the given day is in
+           backups must be sorted by date, like the list_backups_* results"""
+        start = datetime.datetime(date.year, date.month, 1)
+        end = datetime.datetime(date.year + 1, 1, 1) if date.month == 12 else datetime.datetime(date.year, date.month + 1, 1)
+        return _first_between(backups, start, end)
+
+    def should_promote_daily_backup(self, date, now=None):
+        if now is None:
+            now = datetime.datetime.now(datetime.timezone.utc)
         if now.date() > date or now.hour >= 12:
             # If it is already 13:00 or a later date a backup should be promoted if none exists
-            return not self.get_backup_daily_for_date(date) and self.keepdict['daily'] > 0
+            return self.keepdict['daily'] > 0 and not self.get_backup_daily_for_date(date)
         return False
 
     def should_promote_weekly_backup(self, date):
-        return not self.get_backup_weekly_for_date(date) and self.keepdict['weekly'] > 0
+        return self.keepdict['weekly'] > 0 and not self.get_backup_weekly_for_date(date)
 
     def should_promote_monthly_backup(self, date):
-        return not self.get_backup_monthly_for_date(date) and self.keepdict['monthly'] > 0
+        return self.keepdict['monthly'] > 0 and not self.get_backup_monthly_for_date(date)
 
     def list_backups_to_delete(self):
         recents = self.list_backups_recent()
@@ -141,66 +261,125 @@ class BackupRoll:
         weeklykeep = self.keepdict['weekly']
         monthlykeep = self.keepdict['monthly']
 
-        return recents[:-recentkeep] + daily[:-dailykeep] + weekly[:-weeklykeep] + monthly[:-monthlykeep]
+        return _head(recents, recentkeep) + _head(daily, dailykeep) + _head(weekly, weeklykeep) + _head(monthly, monthlykeep)
 
     def promote_backup_to_dir(self, backup, directory):
         if self.verbose:
-            print("Promoting {} to dir: {}".format(backup, directory))
+            _log("Promoting {} to dir: {}".format(backup, directory), name=self.name)
         if not self.simulate:
-            try:
-                os.makedirs(directory)
-            except FileExistsError:
-                pass
             os.link(backup.path, os.path.join(directory, backup.filename))
+            self._invalidate(directory)
 
     def promote_backups(self):
-        date = datetime.datetime.utcnow().date()
-        if self.should_promote_daily_backup(date):
+        self._prefetch()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        date = now.date()
+        if not self.simulate:
+            for directory in (self.dailydir, self.weeklydir, self.monthlydir):
+                os.makedirs(directory, exist_ok=True)
+        if self.should_promote_daily_backup(date, now):
             if self.verbose:
-                print("We should promote a daily backup")
+                _log("We should promote a daily backup", name=self.name)
             backup_to_promote = self.select_promote_daily_backup(self.list_backups_recent(), date)
             if backup_to_promote:
                 self.promote_backup_to_dir(backup_to_promote, self.dailydir)
             elif self.verbose:
-                print("Can't find a daily backup to promote. Try later.")
+                _log("Can't find a daily backup to promote. Try later.", name=self.name)
 
         if self.should_promote_weekly_backup(date):
             if self.verbose:
-                print("We should promote a weekly backup")
+                _log("We should promote a weekly backup", name=self.name)
             backup_to_promote = self.select_promote_weekly_backup(self.list_backups_daily(), date)
             if backup_to_promote:
                 self.promote_backup_to_dir(backup_to_promote, self.weeklydir)
             elif self.verbose:
-                print("Can't find a weekly backup to promote. Try later.")
+                _log("Can't find a weekly backup to promote. Try later.", name=self.name)
 
         if self.should_promote_monthly_backup(date):
             if self.verbose:
-                print("We should promote a monthly backup")
+                _log("We should promote a monthly backup", name=self.name)
             backup_to_promote = self.select_promote_monthly_backup(self.list_backups_daily(), date)
             if backup_to_promote:
                 self.promote_backup_to_dir(backup_to_promote, self.monthlydir)
             elif self.verbose:
-                print("Can't find a monthly backup to promote. Try later.")
+                _log("Can't find a monthly backup to promote. Try later.", name=self.name)
 
-    def delete_backup(self, backup):
+    def delete_backup(self, backup, dir_fd=None):
+        """Deletes the backup. If dir_fd is given it must be a file descriptor of the backup's folder"""
         if self.verbose:
-            print("Deleting {}".format(backup))
+            _log("Deleting {}".format(backup), name=self.name)
         if not self.simulate:
-            os.remove(backup.path)
+            if dir_fd is None:
+                os.remove(backup.path)
+            else:
+                os.unlink(backup.filename, dir_fd=dir_fd)
+            self._invalidate(backup.basedir)
 
     def cleanup_backups(self):
+        self._prefetch()
         to_delete = self.list_backups_to_delete()
-        for backup in to_delete:
-            self.delete_backup(backup)
+        use_dir_fd = not self.simulate and os.unlink in os.supports_dir_fd
+        for folder, backups in itertools.groupby(to_delete, key=lambda b: b.basedir):
+            # Resolve each folder only once instead of once per deleted backup
+            dir_fd = os.open(folder, os.O_RDONLY | os.O_DIRECTORY) if use_dir_fd else None
+            try:
+                for backup in backups:
+                    self.delete_backup(backup, dir_fd=dir_fd)
+            finally:
+                if dir_fd is not None:
+                    os.close(dir_fd)
 
     def list_backups_from(self, folder):
+        """Lists the backups in the given folder, sorted by date
+           Listings are cached for the lifetime of this BackupRoll and invalidated when it changes the folder"""
+        if folder not in self._cache:
+            self._cache[folder] = self._scan(folder)
+        return self._cache[folder]
+
+    def _prefetch(self):
+        """Scans all backup folders not yet cached in parallel, the scans mostly wait on the filesystem"""
+        folders = [ f for f in (self.backupdir, self.dailydir, self.weeklydir, self.monthlydir) if f not in self._cache ]
+        if len(folders) == 0:
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(folders)) as executor:
+            for folder, backups in zip(folders, executor.map(self._scan, folders)):
+                self._cache[folder] = backups
+
+    def _index(self, folder, attr):
+        """Maps each value of the given BackupFile attribute to the earliest backup in the folder having it"""
+        key = (folder, attr)
+        if key not in self._index_cache:
+            index = {}
+            for backup in self.list_backups_from(folder):
+                index.setdefault(getattr(backup, attr), backup)
+            self._index_cache[key] = index
+        return self._index_cache[key]
+
+    def _invalidate(self, folder):
+        self._cache.pop(folder, None)
+        for key in [ k for k in self._index_cache if k[0] == folder ]:
+            del self._index_cache[key]
+
+    def _scan(self, folder):
+        """Lists the backups in the given folder, sorted by date
+           Files matching prefix and suffix without a valid date in between aren't backups and are skipped, otherwise
+           they would be sorted among the backups and hold a keep slot forever"""
+        backups = []
         try:
-            files = [ f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f)) and
-                f.startswith(self.prefix) and f.endswith(self.suffix) ]
-            backups = [ BackupFile(folder, f, self.prefix, self.suffix, self.dateformat) for f in files ]
-            return self.sorted_backups(backups)
+            with os.scandir(folder) as it:
+                for entry in it:
+                    match = self._name_re.match(entry.name)
+                    if match is None or not entry.is_file(follow_symlinks=False):
+                        continue
+                    try:
+                        parsed = self._parse(match.group(1))
+                    except ValueError:
+                        _log("Ignoring {}: not a backup with a date in the format {}".format(entry.path, self.dateformat), file=sys.stderr, name=self.name)
+                        continue
+                    backups.append(BackupFile(folder, entry.name, parsed, path=entry.path))
         except FileNotFoundError:
             return []
+        return self.sorted_backups(backups)
 
     def list_backups_recent(self):
         return self.list_backups_from(self.backupdir)
@@ -215,74 +394,103 @@ class BackupRoll:
         return self.list_backups_from(self.monthlydir)
 
     def get_backup_daily_for_date(self, date):
-        for backup in self.list_backups_daily():
-            if backup.datetime.date() == date:
-                return backup
+        return self._index(self.dailydir, 'date').get(date)
 
     def get_backup_weekly_for_date(self, date):
-        weeknumber = date.isocalendar()[1]
-        for backup in self.list_backups_weekly():
-            if backup.datetime.isocalendar()[1] == weeknumber:
-                return backup
+        return self._index(self.weeklydir, 'isoweek').get(tuple(date.isocalendar()[:2]))
 
     def get_backup_monthly_for_date(self, date):
-        for backup in self.list_backups_monthly():
-            if backup.datetime.month == date.month:
-                return backup
+        return self._index(self.monthlydir, 'month').get((date.year, date.month))
 
 def get_default_backuproll(world, simulate=False):
     return BackupRoll('/opt/wurstmineberg/backup/{}'.format(world), '{}_'.format(world), '.tar.gz', '%Y-%m-%d_%Hh%M', None, simulate=simulate)
 
 class BackupRunner:
-    def __init__(self, command, simulate=False, verbose=False):
+    def __init__(self, command, simulate=False, verbose=False, name=None):
+        """command is the backup command as a list of arguments, it is executed directly without a shell"""
         self.command = command
         self.simulate = simulate
         self.verbose = verbose
+        self.name = name
 
     def run_blocking(self):
         if self.verbose:
-            print("Running command '{}'".format(self.command))
+            _log("Running command '{}'".format(' '.join(shlex.quote(arg) for arg in self.command)), name=self.name)
         if not self.simulate:
             out = None if self.verbose else subprocess.PIPE
-            return subprocess.run(self.command, stdout=out, stderr=out, shell=True, universal_newlines=True)
-
-def do_backuproll(worlds, backupcommand, has_world_prefix=True, extension='tar.gz', dateformat='%Y-%m-%d_%Hh%M', simulate=False, verbose=False):
-    for world in worlds:
-        command = backupcommand + ' ' + world
-        runner = BackupRunner(command, simulate, verbose)
-        ret = runner.run_blocking()
-
-        if ret is not None and ret.returncode != 0:
-            print("Backup failed! Not running backuproll!", file=sys.stderr)
-            if ret.stdout is not None:
-                print('stdout:')
-                print(ret.stdout)
-            if ret.stderr is not None:
-                print('stderr:')
-                print(ret.stderr)
-            exit(1)
-
-        prefix = world + '_' if has_world_prefix else ''
-        keepdict = CONFIG['worlds'][world]['keep']
-        roll = BackupRoll(str(CONFIG['backupfolder'] / world), prefix, '.' + extension, dateformat, keepdict, simulate=simulate, verbose=verbose)
-        roll.promote_backups()
-        roll.cleanup_backups()
+            # subprocess can only use posix_spawn instead of fork+exec if the executable is given as a path and the
+            # file descriptors aren't closed in the child. Ours aren't inheritable anyway (PEP 446).
+            executable = shutil.which(self.command[0]) or self.command[0]
+            try:
+                return subprocess.run(self.command, executable=executable, stdout=out, stderr=out, close_fds=False,
+                    universal_newlines=True)
+            except OSError as e:
+                # Without a shell there is no exit status 127 for a missing command, report it the same way instead
+                return subprocess.CompletedProcess(self.command, 127, stdout=None, stderr=str(e))
+
+def do_backuproll_world(world, backupcommand, backupfolder, has_world_prefix=True, extension='tar.gz', dateformat='%Y-%m-%d_%Hh%M', simulate=False, verbose=False):
+    """Backs up and rolls a single world, returns False if the backup failed"""
+    command = backupcommand + [world]
+    runner = BackupRunner(command, simulate, verbose, name=world)
+    ret = runner.run_blocking()
+
+    if ret is not None and ret.returncode != 0:
+        report = ["Backup of world {} failed! Not running backuproll for it!".format(world)]
+        if ret.stdout is not None:
+            report += ['stdout:', ret.stdout]
+        if ret.stderr is not None:
+            report += ['stderr:', ret.stderr]
+        _log('\n'.join(report), file=sys.stderr)
+        return False
+
+    prefix = world + '_' if has_world_prefix else ''
+    keepdict = CONFIG['worlds'][world]['keep']
+    roll = BackupRoll(os.path.join(backupfolder, world), prefix, '.' + extension, dateformat, keepdict, simulate=simulate, verbose=verbose, name=world)
+    roll.promote_backups()
+    roll.cleanup_backups()
+    return True
+
+def do_backuproll(worlds, backupcommand, has_world_prefix=True, extension='tar.gz', dateformat='%Y-%m-%d_%Hh%M', simulate=False, verbose=False, jobs=1):
+    backupcommand = shlex.split(backupcommand)
+    backupfolder = CONFIG['backupfolder']
+    failed = threading.Event()
+
+    def roll_world(world):
+        # A failing world shouldn't keep the others from being backed up and rolled
+        try:
+            if not do_backuproll_world(world, backupcommand, backupfolder, has_world_prefix, extension, dateformat, simulate=simulate, verbose=verbose):
+                failed.set()
+        except Exception:
+            _log("Backuproll for world {} failed!\n{}".format(world, traceback.format_exc().rstrip('\n')), file=sys.stderr)
+            failed.set()
+
+    # Worlds are independent and mostly wait on the backup command, so they can run in threads
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for _ in executor.map(roll_world, worlds):
+            pass
+    if failed.is_set():
+        exit(1)
 
 if __name__ == "__main__":
     arguments = docopt(__doc__, version='Minecraft backup roll ' + __version__)
     CONFIG_FILE = pathlib.Path(arguments['--config'])
 
-    CONFIG = DEFAULT_CONFIG.copy()
+    CONFIG = copy.deepcopy(DEFAULT_CONFIG)
     with contextlib.suppress(FileNotFoundError):
-        with CONFIG_FILE.open() as config_file:
-            CONFIG.update(json.load(config_file))
-    CONFIG['backupfolder'] = pathlib.Path(CONFIG['backupfolder'])
+        config_data = CONFIG_FILE.read_bytes()
+        CONFIG.update(orjson.loads(config_data) if orjson is not None else json.loads(config_data.decode('utf-8')))
+    for world_config in CONFIG['worlds'].values():
+        # Keep counts missing from a world's config fall back to the defaults
+        world_config['keep'] = dict(DEFAULT_KEEP, **world_config.get('keep', {}))
+    # Kept as a plain string, do_backuproll joins world folders onto it with os.path.join
+    CONFIG['backupfolder'] = str(CONFIG['backupfolder'])
 
     backupcommand = CONFIG['backupcommand']
 
-    selected_worlds = CONFIG['worlds'].keys()
     if arguments['<world>'] and not arguments['--all']:
-        selected_worlds = [arguments['<world>']]
+        selected_worlds = (arguments['<world>'],)
+    else:
+        selected_worlds = tuple(CONFIG['worlds'])
     if len(selected_worlds) == 0:
         print("No world selected and none found in the config file. Exiting.")
         exit(1)
@@ -297,22 +505,26 @@ if __name__ == "__main__":
         simulate = True
         verbose = True
 
+    try:
+        jobs = int(arguments['--jobs'] or CONFIG['max_parallel_worlds'])
+    except (TypeError, ValueError):
+        jobs = 0
+    if jobs < 1:
+        print("--jobs and max_parallel_worlds must be positive integers.", file=sys.stderr)
+        exit(1)
+
     pid_filename = CONFIG['pidfile']
-    if os.path.isfile(pid_filename):
-        with open(pid_filename, 'r') as pidfile:
-            try:
-                pid = int(pidfile.read())
-            except ValueError:
-                pid = None
-        if pid:
-            try:
-                os.kill(pid, 0)
-                print("Another backuproll process is still running. Terminating.", file=sys.stderr)
-                exit(1)
-            except ProcessLookupError:
-                pass
-    mypid = os.getpid()
-    with open(pid_filename, "w+") as pidfile:
-        pidfile.write(str(mypid))
-    do_backuproll(selected_worlds, backupcommand, simulate=simulate, verbose=verbose)
-    os.remove(pid_filename)
+    pid_fd = os.open(pid_filename, os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        fcntl.flock(pid_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print("Another backuproll process is still running. Terminating.", file=sys.stderr)
+        exit(1)
+    # The lock is held until this process exits, the pid is only informational
+    os.ftruncate(pid_fd, 0)
+    os.write(pid_fd, str(os.getpid()).encode())
+    do_backuproll(selected_worlds, backupcommand, simulate=simulate, verbose=verbose, jobs=jobs)
+    # The pidfile is left in place: unlinking it while locked would let a run that opened the old file and one that
+    # creates a new file both get a lock
+    os.ftruncate(pid_fd, 0)
+    os.close(pid_fd)